@@ -3,6 +3,7 @@
 # 通过设置环境变量TF_KERAS=1来切换tf.keras
 
 import os, sys
+from contextlib import contextmanager
 from distutils.util import strtobool
 import numpy as np
 import tensorflow as tf
@@ -28,14 +29,14 @@ do_recompute = strtobool(os.environ.get('RECOMPUTE', '0'))
 def gelu_erf(x):
     """基于Erf直接计算的gelu函数
     """
-    return 0.5 * x * (1.0 + tf.math.erf(x / np.sqrt(2.0)))
+    return 0.5 * x * (1.0 + tf.math.erf(x * np.sqrt(0.5)))
 
 
 def gelu_tanh(x):
     """基于Tanh近似计算的gelu函数
     """
     cdf = 0.5 * (
-        1.0 + K.tanh((np.sqrt(2 / np.pi) * (x + 0.044715 * K.pow(x, 3))))
+        1.0 + K.tanh((np.sqrt(2 / np.pi) * x * (1.0 + 0.044715 * x * x)))
     )
     return x * cdf
 
@@ -114,6 +115,14 @@ def search_layer(inputs, name, exclude_from=None):
                     return layer
 
 
+def large_value(dtype=None):
+    """mask时所用的大正数
+    float16的最大值约为6.5e4，不能直接用1e12。
+    """
+    dtype = dtype or K.floatx()
+    return 1e4 if dtype == 'float16' else 1e12
+
+
 def sequence_masking(x, mask, mode=0, axis=None):
     """为序列条件mask的函数
     mask: 形如(batch_size, seq_len)的0-1矩阵；
@@ -133,10 +142,11 @@ def sequence_masking(x, mask, mode=0, axis=None):
             mask = K.expand_dims(mask, 1)
         for _ in range(K.ndim(x) - K.ndim(mask)):
             mask = K.expand_dims(mask, K.ndim(mask))
+        mask = K.cast(mask, K.dtype(x))
         if mode == 0:
             return x * mask
         else:
-            return x - (1 - mask) * 1e12
+            return x - (1 - mask) * large_value(K.dtype(x))
 
 
 def batch_gather(params, indices):
@@ -205,14 +215,55 @@ class Sinusoidal(keras.initializers.Initializer):
         """
         vocab_size, depth = shape
         embeddings = np.zeros(shape)
-        for pos in range(vocab_size):
-            for i in range(depth // 2):
-                theta = pos / np.power(10000, 2. * i / depth)
-                embeddings[pos, 2 * i] = np.sin(theta)
-                embeddings[pos, 2 * i + 1] = np.cos(theta)
+        indices = np.arange(depth // 2)
+        indices = np.power(10000., -2. * indices / depth)
+        theta = np.outer(np.arange(vocab_size), indices)
+        theta = np.stack([np.sin(theta), np.cos(theta)], axis=-1)
+        embeddings[:, :depth // 2 * 2] = theta.reshape((vocab_size, -1))
         return embeddings
 
 
+@contextmanager
+def mixed_precision_scope(compute_dtype=None):
+    """混合精度上下文
+    在此上下文内新建的层以compute_dtype计算、以float32保存权重，
+    compute_dtype可选float16或bfloat16（仅tf.keras可用）。
+    """
+    if compute_dtype is None or compute_dtype == 'float32':
+        yield
+        return
+
+    if not is_tf_keras:
+        raise ValueError('mixed precision is only supported by tf.keras')
+
+    mixed_precision = keras.mixed_precision
+    if hasattr(mixed_precision, 'set_global_policy'):  # tf 2.4+
+        global_policy = mixed_precision.global_policy
+        set_global_policy = mixed_precision.set_global_policy
+    else:
+        global_policy = mixed_precision.experimental.global_policy
+        set_global_policy = mixed_precision.experimental.set_policy
+
+    old_policy = global_policy()
+    set_global_policy('mixed_%s' % compute_dtype)
+    try:
+        yield
+    finally:
+        set_global_policy(old_policy)
+
+
+def jit_compile_function(f):
+    """用XLA编译函数f（仅tf.keras可用）
+    """
+    if not is_tf_keras:
+        raise ValueError('jit_compile is only supported by tf.keras')
+
+    try:
+        return tf.function(f, jit_compile=True)  # tf 2.5+
+    except TypeError:
+        return tf.function(f, experimental_compile=True)
+
+
 def symbolic(f):
     """恒等装饰器（兼容旧版本keras用）
     """
@@ -141,7 +141,8 @@ class Embedding(keras.layers.Embedding):
         if mode == 'embedding':
             return super(Embedding, self).call(inputs)
         else:
-            kernel = K.transpose(self.embeddings)
+            # 旧版tf.keras的Embedding固定以float32计算，混合精度下需对齐精度
+            kernel = K.cast(K.transpose(self.embeddings), K.dtype(inputs))
             return K.dot(inputs, kernel)
 
     def compute_output_shape(self, input_shape):
@@ -155,6 +156,60 @@ class Embedding(keras.layers.Embedding):
             return input_shape[:2] + (K.int_shape(self.embeddings)[0],)
 
 
+class QuantizedEmbedding(Embedding):
+    """int8量化的Embedding层（仅用于推理）
+    每一行用一个缩放因子做对称量化，权重存储约为原来的1/4。
+    说明：1、dense模式（如共享权重的MLM/LM输出层）每次前向都会把整个
+            词表反量化成浮点矩阵，所以计算时的显存并不会减少；
+          2、量化权重初始化为全零且不可训练，必须从预训练权重加载
+            （如load_weights_from_checkpoint）后才能使用。
+    """
+    def build(self, input_shape):
+        self.embeddings = self.add_weight(
+            name='embeddings',
+            shape=(self.input_dim, self.output_dim),
+            initializer='zeros',
+            dtype='int8',
+            trainable=False
+        )
+        self.scales = self.add_weight(
+            name='scales',
+            shape=(self.input_dim, 1),
+            initializer='ones',
+            trainable=False
+        )
+        self.built = True
+
+    def call(self, inputs, mode='embedding'):
+        """查表或者转置矩阵乘法前先反量化
+        """
+        if mode == 'embedding':
+            if K.dtype(inputs) != 'int32':
+                inputs = K.cast(inputs, 'int32')
+            scales = K.gather(self.scales, inputs)
+            embeddings = K.gather(self.embeddings, inputs)
+            return K.cast(embeddings, K.dtype(scales)) * scales
+        else:
+            scales = K.cast(self.scales, K.dtype(inputs))
+            embeddings = K.cast(self.embeddings, K.dtype(inputs)) * scales
+            return K.dot(inputs, K.transpose(embeddings))
+
+    @staticmethod
+    def quantize(embeddings):
+        """将浮点权重按行量化，返回int8权重与缩放因子
+        """
+        scales = np.abs(embeddings).max(axis=1, keepdims=True) / 127.
+        scales[scales == 0] = 1.
+        embeddings = np.round(embeddings / scales).astype('int8')
+        return embeddings, scales.astype(K.floatx())
+
+    @staticmethod
+    def dequantize(embeddings, scales):
+        """quantize的逆运算
+        """
+        return embeddings.astype(K.floatx()) * scales
+
+
 class BiasAdd(Layer):
     """加上偏置项
     """
@@ -200,6 +255,20 @@ class Concatenate1D(Layer):
             return (input_shape[0][0], None, input_shape[0][2])
 
 
+class TakeFirstToken(Layer):
+    """取序列的第一个向量（比如BERT的CLS向量）
+    说明：相比于Lambda层，这里不需要序列化函数，并且能静态推断shape。
+    """
+    def call(self, inputs):
+        return inputs[:, 0]
+
+    def compute_mask(self, inputs, mask=None):
+        return None
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[:1] + input_shape[2:]
+
+
 class MultiHeadAttention(Layer):
     """多头注意力机制
     """
@@ -438,27 +507,36 @@ class LayerNormalization(Layer):
                 cond = self.hidden_dense(cond)
             for _ in range(K.ndim(inputs) - K.ndim(cond)):
                 cond = K.expand_dims(cond, 1)
+            # 混合精度下内部的Dense层可能以半精度输出，统一到inputs的精度
+            dtype = K.dtype(inputs)
             if self.center:
-                beta = self.beta_dense(cond) + self.beta
+                beta = K.cast(self.beta_dense(cond), dtype) + self.beta
             if self.scale:
-                gamma = self.gamma_dense(cond) + self.gamma
+                gamma = K.cast(self.gamma_dense(cond), dtype) + self.gamma
         else:
             if self.center:
                 beta = self.beta
             if self.scale:
                 gamma = self.gamma
 
-        outputs = inputs
-        if self.center:
-            mean = K.mean(outputs, axis=-1, keepdims=True)
-            outputs = outputs - mean
-        if self.scale:
-            variance = K.mean(K.square(outputs), axis=-1, keepdims=True)
-            std = K.sqrt(variance + self.epsilon)
-            outputs = outputs / std
-            outputs = outputs * gamma
-        if self.center:
-            outputs = outputs + beta
+        if self.center and self.scale:
+            # 常规情形：用融合的moments和batch_normalization算子完成计算
+            mean, variance = tf.nn.moments(inputs, axes=[-1], keepdims=True)
+            outputs = tf.nn.batch_normalization(
+                inputs, mean, variance, beta, gamma, self.epsilon
+            )
+        else:
+            outputs = inputs
+            if self.center:
+                mean = K.mean(outputs, axis=-1, keepdims=True)
+                outputs = outputs - mean
+            if self.scale:
+                variance = K.mean(K.square(outputs), axis=-1, keepdims=True)
+                std = K.sqrt(variance + self.epsilon)
+                outputs = outputs / std
+                outputs = outputs * gamma
+            if self.center:
+                outputs = outputs + beta
 
         return outputs
 
@@ -483,6 +561,42 @@ class LayerNormalization(Layer):
         return dict(list(base_config.items()) + list(config.items()))
 
 
+class ResidualLayerNormalization(LayerNormalization):
+    """Dropout、残差相加与Layer Normalization合并为一层
+    输入为[xi, x]，输出为LN(xi + Dropout(x))，权重与LayerNormalization一致。
+    """
+    def __init__(self, rate=0., **kwargs):
+        super(ResidualLayerNormalization, self).__init__(**kwargs)
+        self.rate = rate
+
+    def compute_mask(self, inputs, mask=None):
+        if mask is not None:
+            masks = [m[None] for m in mask if m is not None]
+            if len(masks) > 0:
+                return K.all(K.concatenate(masks, axis=0), axis=0)
+
+    def build(self, input_shape):
+        super(ResidualLayerNormalization, self).build(input_shape[0])
+
+    def call(self, inputs, training=None):
+        xi, x = inputs
+        if self.rate > 0:
+            x = K.in_train_phase(
+                K.dropout(x, self.rate), x, training=training
+            )
+        return super(ResidualLayerNormalization, self).call(xi + x)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[0]
+
+    def get_config(self):
+        config = {
+            'rate': self.rate,
+        }
+        base_config = super(ResidualLayerNormalization, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
 class PositionEmbedding(Layer):
     """定义可训练的位置Embedding
     """
@@ -1166,10 +1280,13 @@ class Loss(Layer):
 
 custom_objects = {
     'Embedding': Embedding,
+    'QuantizedEmbedding': QuantizedEmbedding,
     'BiasAdd': BiasAdd,
     'Concatenate1D': Concatenate1D,
+    'TakeFirstToken': TakeFirstToken,
     'MultiHeadAttention': MultiHeadAttention,
     'LayerNormalization': LayerNormalization,
+    'ResidualLayerNormalization': ResidualLayerNormalization,
     'PositionEmbedding': PositionEmbedding,
     'SinusoidalPositionEmbedding': SinusoidalPositionEmbedding,
     'RelativePositionEmbedding': RelativePositionEmbedding,
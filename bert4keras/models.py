@@ -2,12 +2,18 @@
 # 主要模型
 
 import numpy as np
+import tensorflow as tf
 from bert4keras.layers import *
+from bert4keras.backend import mixed_precision_scope
+from bert4keras.backend import jit_compile_function
+from bert4keras.backend import large_value
 from bert4keras.snippets import insert_arguments
 from bert4keras.snippets import delete_arguments
 from bert4keras.snippets import is_string
 from keras.models import Model
 import json
+import os
+import warnings
 
 
 class Transformer(object):
@@ -29,11 +35,18 @@ class Transformer(object):
         keep_tokens=None,  # 要保留的词ID列表
         compound_tokens=None,  # 扩展Embedding
         residual_attention_scores=False,  # Attention矩阵加残差
+        compute_dtype=None,  # 计算精度，float16/bfloat16时启用混合精度
         layers=None,  # 外部传入的Keras层
         prefix=None,  # 层名前缀
         name=None,  # 模型名称
         **kwargs
     ):
+        if kwargs.get('quantize_embeddings'):
+            # 只有BERT系列模型实现了量化Embedding，避免该参数被静默忽略
+            raise ValueError(
+                '%s does not support quantize_embeddings' %
+                self.__class__.__name__
+            )
         if keep_tokens is not None:
             vocab_size = len(keep_tokens)
         if compound_tokens is not None:
@@ -55,6 +68,7 @@ class Transformer(object):
         self.position_bias = None
         self.attention_scores = None
         self.residual_attention_scores = residual_attention_scores
+        self.compute_dtype = compute_dtype
         self.layers = {} if layers is None else layers
         self.prefix = prefix or ''
         self.name = name
@@ -67,13 +81,26 @@ class Transformer(object):
         layer_norm_cond_hidden_size=None,
         layer_norm_cond_hidden_act=None,
         additional_input_layers=None,
+        jit_compile=False,
         **kwargs
     ):
         """模型构建函数
         attention_caches：为Attention的K,V的缓存序列字典，格式为
                          {Attention层名: [K缓存, V缓存]}；
         layer_norm_*系列参数：实现Conditional Layer Normalization时使用，
-                            用来实现以“固定长度向量”为条件的条件Bert。
+                            用来实现以“固定长度向量”为条件的条件Bert；
+        jit_compile：是否用XLA编译模型的前向计算（仅tf.keras可用）。XLA对
+                     每种新的输入shape都会重新编译，而按batch内最长样本
+                     padding时几乎每个batch的长度都不同，所以需要固定
+                     sequence_length（或者分桶padding），否则反而更慢。
+                     其实现是直接替换self.model.call，只作用于self.model
+                     本身：基于self.model.output再搭建的新Model（包括T5
+                     合并encoder、decoder得到的模型）不会被编译。tf>=2.5
+                     时建议改用最终模型的model.compile(..., jit_compile=True)。
+        说明：compute_dtype为float16时，self.model在compile时会自动启用
+             loss scaling；但在self.model之外再包一层的Model（比如加了
+             下游输出层）默认是float32策略，训练时需自行用
+             LossScaleOptimizer包装优化器，否则梯度可能下溢。
         """
         if self.built:
             return None
@@ -88,10 +115,19 @@ class Transformer(object):
             layer_norm_cond_hidden_act or 'linear',
         ]
         # Call
-        outputs = self.call(inputs)
-        self.set_outputs(outputs)
-        # Model
-        self.model = Model(self.inputs, self.outputs, name=self.name)
+        with mixed_precision_scope(self.compute_dtype):
+            outputs = self.call(inputs)
+            self.set_outputs(outputs)
+            # Model（在混合精度下构建，compile时才会自动启用loss scaling）
+            self.model = Model(self.inputs, self.outputs, name=self.name)
+        if jit_compile:
+            if self.sequence_length is None:
+                warnings.warn(
+                    'jit_compile=True with sequence_length=None: XLA '
+                    'recompiles for every new input length, which is '
+                    'usually slower than not compiling at all.'
+                )
+            self.model.call = jit_compile_function(self.model.call)
         self.built = True
 
     def call(self, inputs):
@@ -119,12 +155,19 @@ class Transformer(object):
         arguments: 传递给layer.call的参数；
         kwargs: 传递给层初始化的参数。
         """
-        if layer is Dropout and self.dropout_rate == 0:
+        if layer is Dropout and kwargs.get('rate', self.dropout_rate) == 0:
             return inputs
 
         if layer is MultiHeadAttention and self.residual_attention_scores:
             kwargs['return_attention_scores'] = True
 
+        if self.compute_dtype is not None and (
+            layer in [Activation, LayerNormalization, ResidualLayerNormalization] or
+            kwargs.get('activation') == 'softmax'
+        ):
+            # 输出层的softmax等激活以及Layer Normalization始终在float32下计算
+            kwargs.setdefault('dtype', 'float32')
+
         arguments = arguments or {}
         name = self.prefixed(kwargs.get('name'))
         kwargs['name'] = name
@@ -225,6 +268,9 @@ class Transformer(object):
     def simplify(self, inputs):
         """将list中的None过滤掉
         """
+        if len(inputs) == 2 and inputs[1] is None:
+            return inputs[0]  # 最常见的[x, None]情形，直接返回
+
         inputs = [i for i in inputs if i is not None]
         if len(inputs) == 1:
             inputs = inputs[0]
@@ -253,11 +299,14 @@ class Transformer(object):
 
     def load_variable(self, checkpoint, name):
         """加载单个变量的函数
+        checkpoint可以是字典、checkpoint路径或者checkpoint的reader。
         """
         if isinstance(checkpoint, dict):
             return checkpoint[name]
-        else:
+        elif is_string(checkpoint):
             return tf.train.load_variable(checkpoint, name)
+        else:
+            return checkpoint.get_tensor(name)
 
     def create_variable(self, name, value, dtype=None):
         """创建一个变量
@@ -276,8 +325,14 @@ class Transformer(object):
         """根据mapping从checkpoint加载权重
         """
         mapping = mapping or self.variable_mapping()
-        mapping = {self.prefixed(k): v for k, v in mapping.items()}
-        mapping = {k: v for k, v in mapping.items() if k in self.layers}
+        mapping = {
+            self.prefixed(k): v
+            for k, v in mapping.items() if self.prefixed(k) in self.layers
+        }
+
+        if is_string(checkpoint):
+            # 只打开一次checkpoint，避免每个变量都重新解析索引
+            checkpoint = tf.train.load_checkpoint(checkpoint)
 
         weight_value_pairs = []
         for layer, variables in mapping.items():
@@ -285,6 +340,10 @@ class Transformer(object):
             weights = layer.trainable_weights
             values = [self.load_variable(checkpoint, v) for v in variables]
 
+            if isinstance(layer, QuantizedEmbedding):
+                weights = layer.weights
+                values = list(layer.quantize(values[0]))
+
             if isinstance(layer, MultiHeadAttention):
                 """如果key_size不等于head_size，则可以通过
                 正交矩阵将相应的权重投影到合适的shape。
@@ -309,6 +368,10 @@ class Transformer(object):
                         values[i] = v
 
             weight_value_pairs.extend(zip(weights, values))
+            if len(weight_value_pairs) >= 32:
+                # 分批赋值，及时释放已读取的权重，降低内存峰值
+                K.batch_set_value(weight_value_pairs)
+                weight_value_pairs = []
 
         K.batch_set_value(weight_value_pairs)
 
@@ -316,14 +379,20 @@ class Transformer(object):
         """根据mapping将权重保存为checkpoint格式
         """
         mapping = mapping or self.variable_mapping()
-        mapping = {self.prefixed(k): v for k, v in mapping.items()}
-        mapping = {k: v for k, v in mapping.items() if k in self.layers}
+        mapping = {
+            self.prefixed(k): v
+            for k, v in mapping.items() if self.prefixed(k) in self.layers
+        }
 
         with tf.Graph().as_default():
             all_variables, all_values = [], []
             for layer, variables in mapping.items():
                 layer = self.layers[layer]
-                values = K.batch_get_value(layer.trainable_weights)
+                if isinstance(layer, QuantizedEmbedding):
+                    values = K.batch_get_value(layer.weights)
+                    values = [layer.dequantize(*values)]
+                else:
+                    values = K.batch_get_value(layer.trainable_weights)
                 for name, value in zip(variables, values):
                     variable, value = self.create_variable(name, value, dtype)
                     all_variables.append(variable)
@@ -342,12 +411,13 @@ class LM_Mask(object):
         """
         if self.attention_bias is None:
 
+            dtype = self.compute_dtype or K.floatx()
+
             def lm_mask(s):
-                seq_len = K.shape(s)[1]
+                seq_len = K.int_shape(s)[1] or K.shape(s)[1]  # 优先用静态长度
                 idxs = K.arange(0, seq_len)
-                mask = idxs[None, :] <= idxs[:, None]
-                mask = K.cast(mask, K.floatx())
-                return -(1 - mask[None, None]) * 1e12
+                mask = idxs[None, :] > idxs[:, None]
+                return K.cast(mask[None, None], dtype) * -large_value(dtype)
 
             self.attention_bias = self.apply(
                 inputs=self.inputs[0],
@@ -369,11 +439,13 @@ class UniLM_Mask(object):
         """
         if self.attention_bias is None:
 
+            dtype = self.compute_dtype or K.floatx()
+
             def unilm_mask(s):
-                idxs = K.cumsum(s, axis=1)
-                mask = idxs[:, None, :] <= idxs[:, :, None]
-                mask = K.cast(mask, K.floatx())
-                return -(1 - mask[:, None]) * 1e12
+                # 混合精度下s会被自动转为半精度，转成整数再累加以保证精确
+                idxs = K.cumsum(K.cast(s, 'int32'), axis=1)
+                mask = idxs[:, None, :] > idxs[:, :, None]
+                return K.cast(mask[:, None], dtype) * -large_value(dtype)
 
             self.attention_bias = self.apply(
                 inputs=self.inputs[1],
@@ -398,6 +470,7 @@ class BERT(Transformer):
         hierarchical_position=None,  # 是否层次分解位置编码
         custom_position_ids=False,  # 是否自行传入位置id
         shared_segment_embeddings=False,  # 若True，则segment跟token共用embedding
+        quantize_embeddings=False,  # 若True，则token embedding量化为int8（仅推理用）
         **kwargs  # 其余参数
     ):
         super(BERT, self).__init__(**kwargs)
@@ -409,9 +482,19 @@ class BERT(Transformer):
         self.hierarchical_position = hierarchical_position
         self.custom_position_ids = custom_position_ids
         self.shared_segment_embeddings = shared_segment_embeddings
+        self.quantize_embeddings = quantize_embeddings
         if self.with_nsp and not self.with_pool:
             self.with_pool = True
 
+    @property
+    def token_embedding_layer(self):
+        """Token Embedding所用的层
+        """
+        if self.quantize_embeddings:
+            return QuantizedEmbedding
+        else:
+            return Embedding
+
     def get_inputs(self):
         """BERT的输入是token_ids和segment_ids
         （但允许自行传入位置id，以实现一些特殊需求）
@@ -454,7 +537,7 @@ class BERT(Transformer):
 
         x = self.apply(
             inputs=x,
-            layer=Embedding,
+            layer=self.token_embedding_layer,
             input_dim=self.vocab_size,
             output_dim=self.embedding_size,
             embeddings_initializer=self.initializer,
@@ -519,7 +602,6 @@ class BERT(Transformer):
         顺序：Att --> Add --> LN --> FFN --> Add --> LN
         """
         x = inputs
-        z = self.layer_norm_conds[0]
 
         attention_name = 'Transformer-%d-MultiHeadSelfAttention' % index
         feed_forward_name = 'Transformer-%d-FeedForward' % index
@@ -542,24 +624,7 @@ class BERT(Transformer):
             kernel_initializer=self.initializer,
             name=attention_name
         )
-        x = self.apply(
-            inputs=x,
-            layer=Dropout,
-            rate=self.dropout_rate,
-            name='%s-Dropout' % attention_name
-        )
-        x = self.apply(
-            inputs=[xi, x], layer=Add, name='%s-Add' % attention_name
-        )
-        x = self.apply(
-            inputs=self.simplify([x, z]),
-            layer=LayerNormalization,
-            conditional=(z is not None),
-            hidden_units=self.layer_norm_conds[1],
-            hidden_activation=self.layer_norm_conds[2],
-            hidden_initializer=self.initializer,
-            name='%s-Norm' % attention_name
-        )
+        x = self.apply_residual_norm([xi, x], attention_name)
 
         # Feed Forward
         xi = x
@@ -571,25 +636,41 @@ class BERT(Transformer):
             kernel_initializer=self.initializer,
             name=feed_forward_name
         )
+        x = self.apply_residual_norm([xi, x], feed_forward_name)
+
+        return x
+
+    def apply_residual_norm(self, inputs, name):
+        """残差部分：Dropout --> Add --> LN
+        无条件LN时合并为一个ResidualLayerNormalization层。
+        """
+        xi, x = inputs
+        z = self.layer_norm_conds[0]
+
+        if z is None:
+            return self.apply(
+                inputs=[xi, x],
+                layer=ResidualLayerNormalization,
+                rate=self.dropout_rate,
+                name='%s-Norm' % name
+            )
+
         x = self.apply(
             inputs=x,
             layer=Dropout,
             rate=self.dropout_rate,
-            name='%s-Dropout' % feed_forward_name
+            name='%s-Dropout' % name
         )
+        x = self.apply(inputs=[xi, x], layer=Add, name='%s-Add' % name)
         x = self.apply(
-            inputs=[xi, x], layer=Add, name='%s-Add' % feed_forward_name
-        )
-        x = self.apply(
-            inputs=self.simplify([x, z]),
+            inputs=[x, z],
             layer=LayerNormalization,
-            conditional=(z is not None),
+            conditional=True,
             hidden_units=self.layer_norm_conds[1],
             hidden_activation=self.layer_norm_conds[2],
             hidden_initializer=self.initializer,
-            name='%s-Norm' % feed_forward_name
+            name='%s-Norm' % name
         )
-
         return x
 
     def apply_final_layers(self, inputs):
@@ -602,12 +683,7 @@ class BERT(Transformer):
         if self.with_pool:
             # Pooler部分（提取CLS向量）
             x = outputs[0]
-            x = self.apply(
-                inputs=x,
-                layer=Lambda,
-                function=lambda x: x[:, 0],
-                name='Pooler'
-            )
+            x = self.apply(inputs=x, layer=TakeFirstToken, name='Pooler')
             pool_activation = 'tanh' if self.with_pool is True else self.with_pool
             x = self.apply(
                 inputs=x,
@@ -769,7 +845,6 @@ class ALBERT(BERT):
         顺序：Att --> Add --> LN --> FFN --> Add --> LN
         """
         x = inputs
-        z = self.layer_norm_conds[0]
 
         attention_name = 'Transformer-MultiHeadSelfAttention'
         feed_forward_name = 'Transformer-FeedForward'
@@ -792,24 +867,7 @@ class ALBERT(BERT):
             kernel_initializer=self.initializer,
             name=attention_name
         )
-        x = self.apply(
-            inputs=x,
-            layer=Dropout,
-            rate=self.dropout_rate,
-            name='%s-Dropout' % attention_name
-        )
-        x = self.apply(
-            inputs=[xi, x], layer=Add, name='%s-Add' % attention_name
-        )
-        x = self.apply(
-            inputs=self.simplify([x, z]),
-            layer=LayerNormalization,
-            conditional=(z is not None),
-            hidden_units=self.layer_norm_conds[1],
-            hidden_activation=self.layer_norm_conds[2],
-            hidden_initializer=self.initializer,
-            name='%s-Norm' % attention_name
-        )
+        x = self.apply_residual_norm([xi, x], attention_name)
 
         # Feed Forward
         xi = x
@@ -821,24 +879,7 @@ class ALBERT(BERT):
             kernel_initializer=self.initializer,
             name=feed_forward_name
         )
-        x = self.apply(
-            inputs=x,
-            layer=Dropout,
-            rate=self.dropout_rate,
-            name='%s-Dropout' % feed_forward_name
-        )
-        x = self.apply(
-            inputs=[xi, x], layer=Add, name='%s-Add' % feed_forward_name
-        )
-        x = self.apply(
-            inputs=self.simplify([x, z]),
-            layer=LayerNormalization,
-            conditional=(z is not None),
-            hidden_units=self.layer_norm_conds[1],
-            hidden_activation=self.layer_norm_conds[2],
-            hidden_initializer=self.initializer,
-            name='%s-Norm' % feed_forward_name
-        )
+        x = self.apply_residual_norm([xi, x], feed_forward_name)
 
         return x
 
@@ -886,33 +927,40 @@ class ALBERT_Unshared(BERT):
         """
         mapping = super(ALBERT_Unshared, self).variable_mapping()
 
+        # 各层都映射到同一组权重，因此只需构建一次
         prefix = 'bert/encoder/transformer/group_0/inner_group_0/'
+        attention = [
+            prefix + 'attention_1/self/query/kernel',
+            prefix + 'attention_1/self/query/bias',
+            prefix + 'attention_1/self/key/kernel',
+            prefix + 'attention_1/self/key/bias',
+            prefix + 'attention_1/self/value/kernel',
+            prefix + 'attention_1/self/value/bias',
+            prefix + 'attention_1/output/dense/kernel',
+            prefix + 'attention_1/output/dense/bias',
+        ]
+        attention_norm = [
+            prefix + 'LayerNorm/beta',
+            prefix + 'LayerNorm/gamma',
+        ]
+        feed_forward = [
+            prefix + 'ffn_1/intermediate/dense/kernel',
+            prefix + 'ffn_1/intermediate/dense/bias',
+            prefix + 'ffn_1/intermediate/output/dense/kernel',
+            prefix + 'ffn_1/intermediate/output/dense/bias',
+        ]
+        feed_forward_norm = [
+            prefix + 'LayerNorm_1/beta',
+            prefix + 'LayerNorm_1/gamma',
+        ]
+
         for i in range(self.num_hidden_layers):
             mapping.update({
-                'Transformer-%d-MultiHeadSelfAttention' % i: [
-                    prefix + 'attention_1/self/query/kernel',
-                    prefix + 'attention_1/self/query/bias',
-                    prefix + 'attention_1/self/key/kernel',
-                    prefix + 'attention_1/self/key/bias',
-                    prefix + 'attention_1/self/value/kernel',
-                    prefix + 'attention_1/self/value/bias',
-                    prefix + 'attention_1/output/dense/kernel',
-                    prefix + 'attention_1/output/dense/bias',
-                ],
-                'Transformer-%d-MultiHeadSelfAttention-Norm' % i: [
-                    prefix + 'LayerNorm/beta',
-                    prefix + 'LayerNorm/gamma',
-                ],
-                'Transformer-%d-FeedForward' % i: [
-                    prefix + 'ffn_1/intermediate/dense/kernel',
-                    prefix + 'ffn_1/intermediate/dense/bias',
-                    prefix + 'ffn_1/intermediate/output/dense/kernel',
-                    prefix + 'ffn_1/intermediate/output/dense/bias',
-                ],
-                'Transformer-%d-FeedForward-Norm' % i: [
-                    prefix + 'LayerNorm_1/beta',
-                    prefix + 'LayerNorm_1/gamma',
-                ],
+                'Transformer-%d-MultiHeadSelfAttention' % i: attention,
+                'Transformer-%d-MultiHeadSelfAttention-Norm' % i:
+                    attention_norm,
+                'Transformer-%d-FeedForward' % i: feed_forward,
+                'Transformer-%d-FeedForward-Norm' % i: feed_forward_norm,
             })
 
         return mapping
@@ -933,7 +981,7 @@ class NEZHA(BERT):
 
         x = self.apply(
             inputs=x,
-            layer=Embedding,
+            layer=self.token_embedding_layer,
             input_dim=self.vocab_size,
             output_dim=self.embedding_size,
             embeddings_initializer=self.initializer,
@@ -987,7 +1035,6 @@ class NEZHA(BERT):
         顺序：Att --> Add --> LN --> FFN --> Add --> LN
         """
         x = inputs
-        z = self.layer_norm_conds[0]
 
         attention_name = 'Transformer-%d-MultiHeadSelfAttention' % index
         feed_forward_name = 'Transformer-%d-FeedForward' % index
@@ -1012,24 +1059,7 @@ class NEZHA(BERT):
             kernel_initializer=self.initializer,
             name=attention_name
         )
-        x = self.apply(
-            inputs=x,
-            layer=Dropout,
-            rate=self.dropout_rate,
-            name='%s-Dropout' % attention_name
-        )
-        x = self.apply(
-            inputs=[xi, x], layer=Add, name='%s-Add' % attention_name
-        )
-        x = self.apply(
-            inputs=self.simplify([x, z]),
-            layer=LayerNormalization,
-            conditional=(z is not None),
-            hidden_units=self.layer_norm_conds[1],
-            hidden_activation=self.layer_norm_conds[2],
-            hidden_initializer=self.initializer,
-            name='%s-Norm' % attention_name
-        )
+        x = self.apply_residual_norm([xi, x], attention_name)
 
         # Feed Forward
         xi = x
@@ -1041,24 +1071,7 @@ class NEZHA(BERT):
             kernel_initializer=self.initializer,
             name=feed_forward_name
         )
-        x = self.apply(
-            inputs=x,
-            layer=Dropout,
-            rate=self.dropout_rate,
-            name='%s-Dropout' % feed_forward_name
-        )
-        x = self.apply(
-            inputs=[xi, x], layer=Add, name='%s-Add' % feed_forward_name
-        )
-        x = self.apply(
-            inputs=self.simplify([x, z]),
-            layer=LayerNormalization,
-            conditional=(z is not None),
-            hidden_units=self.layer_norm_conds[1],
-            hidden_activation=self.layer_norm_conds[2],
-            hidden_initializer=self.initializer,
-            name='%s-Norm' % feed_forward_name
-        )
+        x = self.apply_residual_norm([xi, x], feed_forward_name)
 
         return x
 
@@ -1175,7 +1188,7 @@ class GPT(LM_Mask, BERT):
 
         x = self.apply(
             inputs=x,
-            layer=Embedding,
+            layer=self.token_embedding_layer,
             input_dim=self.vocab_size,
             output_dim=self.embedding_size,
             embeddings_initializer=self.initializer,
@@ -1289,7 +1302,7 @@ class GPT2(GPT):
 
         x = self.apply(
             inputs=x,
-            layer=Embedding,
+            layer=self.token_embedding_layer,
             input_dim=self.vocab_size,
             output_dim=self.embedding_size,
             embeddings_initializer=self.initializer,
@@ -1456,7 +1469,7 @@ class GPT2_ML(GPT):
 
         x = self.apply(
             inputs=x,
-            layer=Embedding,
+            layer=self.token_embedding_layer,
             input_dim=self.vocab_size,
             output_dim=self.embedding_size,
             embeddings_initializer=self.initializer,
@@ -2168,11 +2181,13 @@ class T5_Decoder(LM_Mask, T5_Base):
     def compute_attention_bias(self, inputs=None):
         """修改LM Mask的序列长度（从 self.inputs[0] 改为 self.inputs[1] ）
         """
-        old_inputs = self.inputs[:]
-        self.inputs = [old_inputs[1]]
-        mask = super(T5_Decoder, self).compute_attention_bias(inputs)
-        self.inputs = old_inputs
-        return mask
+        if self.attention_bias is None:
+            old_inputs = self.inputs[:]
+            self.inputs = [old_inputs[1]]
+            super(T5_Decoder, self).compute_attention_bias(inputs)
+            self.inputs = old_inputs
+
+        return self.attention_bias
 
     def compute_position_bias(self, inputs=None):
         """T5相对位置编码
@@ -2239,7 +2254,7 @@ def extend_with_language_model(BaseModel):
         """
         def __init__(self, *args, **kwargs):
             super(LanguageModel, self).__init__(*args, **kwargs)
-            self.with_mlm = self.with_mlm or True
+            self.with_mlm = kwargs.get('with_mlm', True)
 
     return LanguageModel
 
@@ -2253,11 +2268,28 @@ def extend_with_unified_language_model(BaseModel):
         """
         def __init__(self, *args, **kwargs):
             super(UnifiedLanguageModel, self).__init__(*args, **kwargs)
-            self.with_mlm = self.with_mlm or True
+            self.with_mlm = kwargs.get('with_mlm', True)
 
     return UnifiedLanguageModel
 
 
+_configs_cache = {}
+_extended_models = {}
+
+
+def load_config(config_path):
+    """读取json配置文件
+    按（路径，修改时间）缓存解析结果，避免重复构建模型时反复读取；
+    返回的是缓存的副本，修改它不会影响之后的调用。
+    """
+    key = (config_path, os.path.getmtime(config_path))
+    if key not in _configs_cache:
+        with open(config_path) as f:
+            _configs_cache[key] = json.load(f)
+
+    return dict(_configs_cache[key])
+
+
 def build_transformer_model(
     config_path=None,
     checkpoint_path=None,
@@ -2270,7 +2302,7 @@ def build_transformer_model(
     """
     configs = {}
     if config_path is not None:
-        configs.update(json.load(open(config_path)))
+        configs.update(load_config(config_path))
     configs.update(kwargs)
     if 'max_position' not in configs:
         configs['max_position'] = configs.get('max_position_embeddings', 512)
@@ -2313,10 +2345,17 @@ def build_transformer_model(
             (model, application)
         )
 
-    if application == 'lm':
-        MODEL = extend_with_language_model(MODEL)
-    elif application == 'unilm':
-        MODEL = extend_with_unified_language_model(MODEL)
+    if application in ['lm', 'unilm']:
+        # 缓存派生出来的模型类，重复构建时不再新建类
+        key = (MODEL, application)
+        if key not in _extended_models:
+            if application == 'lm':
+                _extended_models[key] = extend_with_language_model(MODEL)
+            else:
+                _extended_models[key] = extend_with_unified_language_model(
+                    MODEL
+                )
+        MODEL = _extended_models[key]
 
     if model.startswith('t5.1.1'):
         configs['version'] = 't5.1.1'
@@ -2326,6 +2365,12 @@ def build_transformer_model(
 
     if checkpoint_path is not None:
         transformer.load_weights_from_checkpoint(checkpoint_path)
+    elif configs.get('quantize_embeddings'):
+        warnings.warn(
+            'quantize_embeddings=True but no checkpoint_path is given: '
+            'the int8 token embeddings stay all zeros until weights are '
+            'loaded (e.g. via load_weights_from_checkpoint).'
+        )
 
     if return_keras_model:
         return transformer.model